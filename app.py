@@ -1,16 +1,20 @@
 import asyncio
+import mmap
 import os
-import threading
-from flask import Flask, request, render_template, make_response, jsonify, send_from_directory, send_file
 
-from ReplyOptimizer.db_functions.users_functions import get_thread
-from db_functions.setup import init_db
-from db_functions.users_functions import get_session, add_user, update_user, get_inbox
-from worker.worker import SessionManager
+import orjson
+from flask import Flask, Response, request, render_template, send_from_directory, send_file
+from werkzeug.wsgi import wrap_file
+
+from db_functions.users_functions import get_session, add_user, update_user, get_inbox, get_thread
+from worker.worker import MAX_SYNC_INTERVAL, SYNC_INTERVAL, SessionManager
 
 app = Flask(__name__)
 manager = SessionManager()
 
+def ojson(obj, status=200):
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
 
 def get_session_log_content(session: str, lines: int = 100) -> str:
     if not session:
@@ -22,42 +26,55 @@ def get_session_log_content(session: str, lines: int = 100) -> str:
         return f"Log for session {session[:8]}... still not created."
 
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            all_lines = f.readlines()
-            last_lines = all_lines[-lines:]
-            return "".join(last_lines)
+        pos = os.path.getsize(filename)
+        buf = b""
+        with open(filename, "rb") as f:
+            while pos > 0 and buf.count(b"\n") <= lines:
+                step = min(8192, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+
+        return b"\n".join(buf.splitlines()[-lines:]).decode("utf-8", "replace")
     except Exception as e:
         return f"Error reading log: {str(e)}"
 
+_page_cache: dict[str, bytes] = {}
+
+def cached_page(template: str, **context) -> Response:
+    key = template if not context else f"{template}:{sorted(context.items())}"
+    body = _page_cache.get(key)
+    if body is None or app.debug:
+        body = _page_cache[key] = render_template(template, **context).encode()
+    return Response(body, mimetype='text/html')
+
 @app.route('/', methods=['GET'])
 def index():
     session = request.cookies.get('session_id')
     if session:
         user = get_session(session)
         if not user:
-            rendered = render_template('auth.html', message="Your previous session has expired")
-
-            resp = make_response(rendered)
+            resp = cached_page('auth.html', message="Your previous session has expired")
             resp.delete_cookie('session_id')
 
             return resp
         else:
-            return render_template("dashboard.html")
+            return cached_page("dashboard.html")
     else:
-        return render_template("auth.html")
+        return cached_page("auth.html")
 
 @app.route('/newUser', methods=['POST'])
 def newUser():
     try:
-        data = request.get_json()
+        data = orjson.loads(request.get_data())
         required_fields = ['gemini_key', 'datadog_key', 'datadog_site', 'imap_host', 'smtp_host', "instructions"]
 
         missing_fields = [field for field in required_fields if field not in data]
         if missing_fields:
-            return jsonify({
+            return ojson({
                 'success': False,
                 'error': f'Missing fields: {", ".join(missing_fields)}'
-            }), 400
+            }, 400)
 
         gemini_key = data['gemini_key']
         datadog_api_key = data['datadog_key']
@@ -69,7 +86,7 @@ def newUser():
         session_id = add_user(gemini_key, datadog_api_key, datadog_site, imap_server, smtp_server, instructions)
 
         if session_id:
-            response = make_response(jsonify({'success': True}))
+            response = ojson({'success': True})
             response.set_cookie(
                 'session_id',
                 session_id,
@@ -79,15 +96,15 @@ def newUser():
             )
             return response
         else:
-            return jsonify({'success': False, 'error': 'Failed to add user'}), 500
+            return ojson({'success': False, 'error': 'Failed to add user'}, 500)
 
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojson({'success': False, 'error': str(e)}, 500)
 
 @app.route('/settings/update', methods=['post'])
 def updateSettings():
     session = request.cookies.get('session_id')
-    data = request.get_json()
+    data = orjson.loads(request.get_data())
 
     if session:
         gemini_key = data['gemini_key']
@@ -100,21 +117,21 @@ def updateSettings():
 
         success = update_user(session, gemini_key, datadog_api_key, datadog_site, imap_server, smtp_server, instructions, imap_accounts)
         if not success:
-            return jsonify({'success': False})
+            return ojson({'success': False})
 
-        return jsonify({'success': True})
+        return ojson({'success': True})
     else:
-        return jsonify({'success': False})
+        return ojson({'success': False})
 
 @app.route('/settings', methods=['GET'])
 def get_settings():
     session = request.cookies.get('session_id')
     if not session:
-        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        return ojson({'success': False, 'error': 'Unauthorized'}, 401)
 
     user_data = get_session(session)
     if not user_data:
-        return jsonify({'success': False, 'error': 'Session not found'}), 404
+        return ojson({'success': False, 'error': 'Session not found'}, 404)
 
     response_data = {
         'success': True,
@@ -128,16 +145,16 @@ def get_settings():
             {
                 'email': acc['mail'],
                 'password': acc['password'],
-                'host': acc['imap_host'].split(':')[0] if ':' in acc['imap_host'] else acc['imap_host'],
-                'port': acc['imap_host'].split(':')[1] if ':' in acc['imap_host'] else '993',
-                'smtp_host': acc['smtp_host'].split(':')[0] if ':' in acc['smtp_host'] else acc['smtp_host'],
-                'smtp_port': acc['smtp_host'].split(':')[1] if ':' in acc['smtp_host'] else '465',
+                'host': acc['imap_host'],
+                'port': acc['imap_port'],
+                'smtp_host': acc['smtp_host'],
+                'smtp_port': acc['smtp_port'],
             }
             for acc in user_data.get('imap_accounts', [])
         ]
     }
 
-    return jsonify(response_data)
+    return ojson(response_data)
 
 @app.route('/inbox', methods=['GET'])
 def inbox_handler():
@@ -145,11 +162,11 @@ def inbox_handler():
     if session:
         inbox = get_inbox(session)
         if inbox:
-            return inbox
+            return app.response_class(inbox, mimetype='application/json')
         else:
-            return jsonify({'success': False})
+            return ojson({'success': False})
     else:
-        return jsonify({'message': 'User unauthorized'}), 401
+        return ojson({'message': 'User unauthorized'}, 401)
 
 @app.route('/thread/<thread_id>', methods=['GET'])
 def thread_handler(thread_id):
@@ -157,26 +174,26 @@ def thread_handler(thread_id):
     if session:
         messages = get_thread(session, thread_id)
         if messages:
-            return messages
+            return ojson(messages)
         else:
-            return jsonify({'success': False})
+            return ojson({'success': False})
     else:
-        return jsonify({'message': 'User unauthorized'}), 401
+        return ojson({'message': 'User unauthorized'}, 401)
 
 @app.route('/logs/get', methods=['GET'])
 def get_logs():
     session = request.cookies.get('session_id')
     if session:
         logs = get_session_log_content(session)
-        return jsonify({'success': True, "logs": logs})
+        return ojson({'success': True, "logs": logs})
     else:
-        return jsonify({'success': False})
+        return ojson({'success': False})
 
 @app.route('/logs/download', methods=['GET'])
 def download_logs():
     session = request.cookies.get('session_id')
     if not session:
-        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        return ojson({'success': False, 'error': 'Unauthorized'}, 401)
 
     filename = f"logs/session_{session[:8]}.log"
     download_name = f"reply_optimizer.log"
@@ -184,31 +201,44 @@ def download_logs():
     if not os.path.exists(filename):
         return "Log not found", 404
 
-    return send_file(
-        filename,
-        as_attachment=True,
-        download_name=download_name,
-        mimetype='text/plain'
-    )
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        mm = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    except ValueError:
+        # empty files cannot be mapped
+        return send_file(
+            filename,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype='text/plain'
+        )
+    finally:
+        os.close(fd)
+
+    resp = Response(wrap_file(request.environ, mm), mimetype='text/plain', direct_passthrough=True)
+    resp.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    resp.headers['Content-Length'] = str(len(mm))
+    return resp
 
 @app.route('/<path:filename>')
 def serve_static(filename):
     return send_from_directory('templates', filename)
 
 async def stop_session(session: str):
-    worker = manager.sessions.get(session)
-    if worker:
-        await worker.stop()
-        manager.sessions.pop(session)
+    async with manager.lock:
+        worker = manager.sessions.pop(session, None)
+        if worker:
+            await worker.stop()
 
 async def manager_loop():
-    while True:
-        await manager.sync_sessions()
-        await asyncio.sleep(30)
+    interval = SYNC_INTERVAL
 
-if __name__ == '__main__':
-    init_db()
+    while True:
+        changed = await manager.sync_sessions()
+        interval = SYNC_INTERVAL if changed else min(interval * 2, MAX_SYNC_INTERVAL)
+        await asyncio.sleep(interval)
 
-    threading.Thread(target=lambda: asyncio.run(manager_loop()), daemon=True).start()
+if __name__ == '__main__' and os.getenv('DEV'):
+    import uvicorn
 
-    app.run(host="0.0.0.0", port=5004, debug=True)
\ No newline at end of file
+    uvicorn.run("asgi:application", host="0.0.0.0", port=5004, reload=True)
\ No newline at end of file
@@ -0,0 +1,37 @@
+import asyncio
+
+from a2wsgi import WSGIMiddleware
+
+from app import app, manager, manager_loop
+from db_functions.setup import init_db
+from db_functions.users_functions import flush_messages
+
+_wsgi = WSGIMiddleware(app, workers=16)
+_manager_task: asyncio.Task | None = None
+
+async def _lifespan(receive, send):
+    global _manager_task
+
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            init_db()
+            _manager_task = asyncio.create_task(manager_loop())
+            await send({"type": "lifespan.startup.complete"})
+
+        elif message["type"] == "lifespan.shutdown":
+            if _manager_task:
+                _manager_task.cancel()
+                await asyncio.gather(_manager_task, return_exceptions=True)
+
+            await manager.stop()
+            await flush_messages()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    else:
+        await _wsgi(scope, receive, send)
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+USERS_DB = "users.db"
+
+_PRAGMAS = """
+    PRAGMA busy_timeout=5000;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA cache_size=-20000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA foreign_keys=ON;
+"""
+
+class PooledConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stmt_cache: dict[str, sqlite3.Cursor] = {}
+
+_write_conn: sqlite3.Connection | None = None
+_write_lock = threading.Lock()
+
+_read_pool: queue.Queue | None = None
+_read_pool_lock = threading.Lock()
+
+_loop_local = threading.local()
+
+_version_conn: sqlite3.Connection | None = None
+_version_lock = threading.Lock()
+
+_inherited: list = []
+
+
+def _connect(read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        conn = sqlite3.connect(
+            f"file:{USERS_DB}?mode=ro", uri=True, isolation_level=None, check_same_thread=False,
+            cached_statements=256, factory=PooledConnection
+        )
+    else:
+        conn = sqlite3.connect(
+            USERS_DB, isolation_level=None, check_same_thread=False,
+            cached_statements=256, factory=PooledConnection
+        )
+
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_PRAGMAS)
+    return conn
+
+def _get_read_pool() -> queue.Queue:
+    global _read_pool
+
+    if _read_pool is None:
+        with _read_pool_lock:
+            if _read_pool is None:
+                pool = queue.Queue(maxsize=os.cpu_count() or 4)
+                for _ in range(pool.maxsize):
+                    pool.put(_connect(read_only=True))
+                _read_pool = pool
+
+    return _read_pool
+
+def exec_cached(conn: PooledConnection, sql: str, params=()) -> sqlite3.Cursor:
+    cur = conn._stmt_cache.get(sql)
+    if cur is None:
+        cur = conn._stmt_cache[sql] = conn.cursor()
+
+    cur.execute(sql, params)
+    return cur
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+@contextmanager
+def read_conn():
+    # an event loop thread gets its own connection so it never blocks on the pool shared with request threads
+    if _on_event_loop():
+        conn = getattr(_loop_local, "conn", None)
+        if conn is None:
+            conn = _loop_local.conn = _connect(read_only=True)
+        yield conn
+        return
+
+    pool = _get_read_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+@contextmanager
+def write_conn():
+    global _write_conn
+
+    with _write_lock:
+        if _write_conn is None:
+            _write_conn = _connect()
+
+        conn = _write_conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+def data_version() -> int:
+    global _version_conn
+
+    # the counter is per connection, so it is always read through the same one
+    with _version_lock:
+        if _version_conn is None:
+            _version_conn = _connect(read_only=True)
+
+        return _version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+def _reset_pool():
+    global _write_conn, _write_lock, _read_pool, _read_pool_lock, _loop_local, _version_conn, _version_lock
+
+    # SQLite handles must not cross fork(); keep the parent's alive so they are never closed here
+    _inherited.append((_write_conn, _read_pool, _loop_local, _version_conn))
+
+    _write_conn = None
+    _write_lock = threading.Lock()
+    _read_pool = None
+    _read_pool_lock = threading.Lock()
+    _loop_local = threading.local()
+    _version_conn = None
+    _version_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_pool)
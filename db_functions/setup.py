@@ -6,6 +6,13 @@ def init_db():
     conn = sqlite3.connect(USERS_DB)
     cur = conn.cursor()
 
+    # auto_vacuum must be set before journal_mode=WAL initialises a new file
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # an existing database only switches mode on a one-time rebuild
+        cur.execute("VACUUM")
+    cur.execute("PRAGMA journal_mode=WAL")
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
         session TEXT NOT NULL UNIQUE,
@@ -21,13 +28,32 @@ def init_db():
     CREATE TABLE IF NOT EXISTS imap_accounts(
         session TEXT NOT NULL,
         imap_host TEXT NOT NULL,
+        imap_port INTEGER NOT NULL DEFAULT 993,
         smtp_host TEXT NOT NULL,
+        smtp_port INTEGER NOT NULL DEFAULT 465,
         mail TEXT NOT NULL UNIQUE,
         password TEXT NOT NULL,
         
         FOREIGN KEY (session) REFERENCES users (session)
     );""")
 
+    columns = {row[1] for row in cur.execute("PRAGMA table_info(imap_accounts)")}
+    if "imap_port" not in columns:
+        cur.execute("ALTER TABLE imap_accounts ADD COLUMN imap_port INTEGER NOT NULL DEFAULT 993")
+        cur.execute("ALTER TABLE imap_accounts ADD COLUMN smtp_port INTEGER NOT NULL DEFAULT 465")
+
+        cur.execute("""
+        UPDATE imap_accounts
+        SET imap_port = CAST(substr(imap_host, instr(imap_host, ':') + 1) AS INTEGER),
+            imap_host = substr(imap_host, 1, instr(imap_host, ':') - 1)
+        WHERE instr(imap_host, ':') > 0""")
+
+        cur.execute("""
+        UPDATE imap_accounts
+        SET smtp_port = CAST(substr(smtp_host, instr(smtp_host, ':') + 1) AS INTEGER),
+            smtp_host = substr(smtp_host, 1, instr(smtp_host, ':') - 1)
+        WHERE instr(smtp_host, ':') > 0""")
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS imap_messages(
         msg_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -41,5 +67,12 @@ def init_db():
         FOREIGN KEY (session) REFERENCES users (session)
     );""")
 
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msgs_session_thread_msg ON imap_messages(session, thread_id, msg_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msgs_thread_session_msg ON imap_messages(thread_id, session, msg_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_imap_accounts_session ON imap_accounts(session)")
+
     conn.commit()
+
+    cur.execute("ANALYZE")
+
     conn.close()
\ No newline at end of file
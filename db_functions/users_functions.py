@@ -1,40 +1,35 @@
 import asyncio
+import functools
 import json
+import logging
 import sqlite3
 import uuid
 
-USERS_DB = "users.db"
+from db_functions.pool import exec_cached, read_conn, write_conn
 
-def get_session(session):
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-
-    cur.execute('''SELECT gemini_key, datadog_api_key, datadog_site, imap_primary_host, smtp_primary_host, instructions FROM users WHERE session = ?''', (session,))
-
-    row = cur.fetchone()
-    if row is None:
-        return None
-
-    gemini_key, datadog_api_key, datadog_site, imap_host, smtp_primary_host, instructions = row
-
-    cur.execute("""SELECT imap_host, smtp_host, mail, password FROM imap_accounts WHERE session = ?""", (session,))
-
-    imap_accounts = cur.fetchall()
-    if imap_accounts is None:
-        imap_accounts_list = []
-    else:
-        imap_accounts_list = []
-        for imap_account in imap_accounts:
-            imap_account_host, smtp_account_host, mail, password = imap_account
-            imap_accounts_list.append({
-                'imap_host': imap_account_host,
-                'smtp_host': smtp_account_host,
-                "mail": mail,
-                "password": password
-            })
+logger = logging.getLogger("reply_optimizer.db")
 
-    conn.commit()
-    conn.close()
+def get_session(session):
+    with read_conn() as conn:
+        cur = exec_cached(conn, """
+            SELECT u.gemini_key, u.datadog_api_key, u.datadog_site, u.imap_primary_host, u.smtp_primary_host, u.instructions,
+                   a.imap_host, a.imap_port, a.smtp_host, a.smtp_port, a.mail, a.password
+            FROM users u
+            LEFT JOIN imap_accounts a ON a.session = u.session
+            WHERE u.session = ?
+        """, (session,))
+
+        rows = cur.fetchall()
+        if not rows:
+            return None
+
+        gemini_key, datadog_api_key, datadog_site, imap_host, smtp_primary_host, instructions = rows[0][:6]
+
+        imap_accounts_list = [
+            {'imap_host': r[6], 'imap_port': r[7], 'smtp_host': r[8], 'smtp_port': r[9], 'mail': r[10], 'password': r[11]}
+            for r in rows
+            if r[10] is not None
+        ]
 
     return {
         'gemini_key': gemini_key,
@@ -49,177 +44,189 @@ def get_session(session):
 def add_user(gemini_key, datadog_api_key, datadog_site, imap_host, smtp_host, instructions):
     if not all([gemini_key, datadog_api_key, datadog_site, imap_host, smtp_host, instructions]):
         raise ValueError("Not all required parameters entered")
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-
     session = str(uuid.uuid4())
 
-    cur.execute("""INSERT INTO users (session, gemini_key, datadog_api_key, datadog_site, imap_primary_host, smtp_primary_host, instructions) VALUES (?,?,?,?,?,?,?)""",
-                (session, gemini_key, datadog_api_key, datadog_site, imap_host, smtp_host, instructions)
-                )
-
-    conn.commit()
-    conn.close()
+    with write_conn() as conn:
+        exec_cached(conn, """INSERT INTO users (session, gemini_key, datadog_api_key, datadog_site, imap_primary_host, smtp_primary_host, instructions) VALUES (?,?,?,?,?,?,?)""",
+                    (session, gemini_key, datadog_api_key, datadog_site, imap_host, smtp_host, instructions)
+                    )
 
     return session
 
-def update_user(session, gemini_key=None, datadog_api_key=None, datadog_site=None, imap_primary_host=None, smtp_primary_host=None, instructions=None, imap_keys=None):
-    fields = []
-    values = []
-
-    if gemini_key is not None:
-        fields.append("gemini_key = ?")
-        values.append(gemini_key)
+_UPD_COLS = {
+    "gemini_key": "gemini_key = ?",
+    "datadog_api_key": "datadog_api_key = ?",
+    "datadog_site": "datadog_site = ?",
+    "imap_primary_host": "imap_primary_host = ?",
+    "smtp_primary_host": "smtp_primary_host = ?",
+    "instructions": "instructions = ?",
+}
 
-    if datadog_api_key is not None:
-        fields.append("datadog_api_key = ?")
-        values.append(datadog_api_key)
+@functools.lru_cache(maxsize=64)
+def _make_update_sql(keys: tuple[str, ...]) -> str:
+    return f"UPDATE users SET {', '.join(_UPD_COLS[k] for k in keys)} WHERE session = ?"
 
-    if datadog_site is not None:
-        fields.append("datadog_site = ?")
-        values.append(datadog_site)
+def _parse_port(value: str, default: int) -> int:
+    if not value:
+        return default
 
-    if imap_primary_host is not None:
-        fields.append("imap_primary_host = ?")
-        values.append(imap_primary_host)
+    port = int(value)
+    if not 0 < port < 65536:
+        raise ValueError(f"port out of range: {port}")
+    return port
 
-    if smtp_primary_host is not None:
-        fields.append("smtp_primary_host = ?")
-        values.append(smtp_primary_host)
+def update_user(session, gemini_key=None, datadog_api_key=None, datadog_site=None, imap_primary_host=None, smtp_primary_host=None, instructions=None, imap_keys=None):
+    candidate = {
+        "gemini_key": gemini_key,
+        "datadog_api_key": datadog_api_key,
+        "datadog_site": datadog_site,
+        "imap_primary_host": imap_primary_host,
+        "smtp_primary_host": smtp_primary_host,
+        "instructions": instructions,
+    }
+    keys = tuple(k for k, v in candidate.items() if v is not None)
 
-    if instructions is not None:
-        fields.append("instructions = ?")
-        values.append(instructions)
+    rows = []
+    for a in imap_keys or ():
+        if not all(a.get(k) for k in ("host", "smtp_host", "email", "password")):
+            continue
 
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
+        imap_host, _, imap_port = a["host"].partition(":")
+        smtp_host, _, smtp_port = a["smtp_host"].partition(":")
+        try:
+            rows.append((session, imap_host, _parse_port(imap_port, 993), smtp_host, _parse_port(smtp_port, 465), a["email"], a["password"]))
+        except ValueError as e:
+            logger.warning("Invalid port in settings update: %s", e)
+            return False
 
     try:
-        if fields:
-            values.append(session)
-            query = f"""
-                UPDATE users
-                SET {", ".join(fields)}
-                WHERE session = ?
-            """
-            cur.execute(query, values)
-
-        if imap_keys:
-            for account in imap_keys:
-                imap_host = account.get("host")
-                smtp_host = account.get("smtp_host")
-                mail = account.get("email")
-                password = account.get("password")
-
-                if not all([imap_host, smtp_host, mail, password]):
-                    continue
-
-                cur.execute("""
-                    SELECT 1 FROM imap_accounts
-                    WHERE session = ? AND mail = ?
-                """, (session, mail))
-
-                exists = cur.fetchone()
-                if exists:
-                    continue
-
-                cur.execute("""
-                    INSERT INTO imap_accounts (session, imap_host, smtp_host, mail, password)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (session, imap_host, smtp_host, mail, password))
-
-        conn.commit()
-        conn.close()
+        with write_conn() as conn:
+            if keys:
+                exec_cached(conn, _make_update_sql(keys), (*(candidate[k] for k in keys), session))
+
+            if rows:
+                conn.executemany("""
+                    INSERT OR IGNORE INTO imap_accounts (session, imap_host, imap_port, smtp_host, smtp_port, mail, password)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+
         return True
 
     except sqlite3.Error as e:
         print("DB ERROR:", e)
-        conn.rollback()
         return False
 
-    finally:
-        conn.close()
+INSERT_MESSAGE_SQL = """
+    INSERT INTO imap_messages (thread_id, session, type, sender, message, subject, mail)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+class MessageBatcher:
+    def __init__(self, max_batch_size: int = 100):
+        self.max_batch_size = max_batch_size
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.task = loop.create_task(self._run())
+
+    def submit(self, row: tuple):
+        self._ensure_running()
+        self.queue.put_nowait(row)
+
+    async def flush(self):
+        if self.queue is not None and self.loop is asyncio.get_running_loop():
+            await self.queue.join()
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await asyncio.to_thread(self.process_batch, batch)
+            except Exception:
+                logger.exception("Failed to write %d message rows", len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def process_batch(self, rows: list[tuple]):
+        try:
+            with write_conn() as conn:
+                conn.executemany(INSERT_MESSAGE_SQL, rows)
+        except sqlite3.Error:
+            if len(rows) == 1:
+                raise
+        else:
+            return
+
+        # the batch mixes rows from every session; one bad row must not drop the rest
+        for row in rows:
+            try:
+                with write_conn() as conn:
+                    exec_cached(conn, INSERT_MESSAGE_SQL, row)
+            except sqlite3.Error:
+                logger.exception("Dropped message row for thread %s", row[0])
+
+_message_batcher = MessageBatcher()
 
 async def insert_message_async(session, thread_id, msg_type, from_addr, message, subject, mail):
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, insert_message, session, thread_id, msg_type, from_addr, message, subject, mail)
+    _message_batcher.submit((thread_id, session, msg_type, from_addr, message, subject, mail))
+
+async def flush_messages():
+    await _message_batcher.flush()
 
 def insert_message(session, thread_id, msg_type, from_addr, message, subject, mail):
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO imap_messages (thread_id, session, type, sender, message, subject, mail)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (thread_id, session, msg_type, from_addr, message, subject, mail))
-    conn.commit()
-    conn.close()
+    with write_conn() as conn:
+        exec_cached(conn, INSERT_MESSAGE_SQL, (thread_id, session, msg_type, from_addr, message, subject, mail))
 
 
 def get_inbox(session):
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-
-    cur.execute("SELECT mail FROM imap_accounts WHERE session = ?", (session,))
-    accounts_raw = cur.fetchall()
-    accounts = [{"mail": mail[0]} for mail in accounts_raw]
-
-    cur.execute("""
-                SELECT msg_id, thread_id, type, sender, message, subject, mail
-                FROM (
-                    SELECT msg_id, thread_id, type, sender, message, subject, mail, ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY msg_id ASC) AS rn
+    with read_conn() as conn:
+        cur = exec_cached(conn, """
+            WITH first_messages AS (
+                SELECT msg_id, thread_id, sender, message, subject, mail
+                FROM imap_messages
+                WHERE msg_id IN (
+                    SELECT MIN(msg_id)
                     FROM imap_messages
-                    WHERE session = ?
-                    ) ranked
-                WHERE rn = 1
-                ORDER BY msg_id DESC
-                """, (session,))
-
-    first_messages = cur.fetchall()
-
-    threads = {}
-    for msg in first_messages:
-        msg_id, thread_id, msg_type, sender, message, subject, mail = msg
-        mail_str = str(mail)
-        if mail_str not in threads:
-            threads[mail_str] = {"messages": []}
-
-        threads[mail_str]["messages"].append({
-            "thread_id": thread_id,
-            "sender": sender,
-            "preview": message[:25] + "..." if len(message) > 25 else message,
-            "subject": subject or "(No subject)",
-        })
-
-    conn.close()
-
-    return {
-        "accounts": accounts,
-        "threads": threads
-    }
+                    WHERE session = ?1
+                    GROUP BY thread_id
+                )
+            )
+            SELECT json_object(
+                'accounts', json((SELECT json_group_array(json_object('mail', mail)) FROM imap_accounts WHERE session = ?1)),
+                'threads', json((
+                    SELECT json_group_object(m.mail, json_object('messages', json((
+                        SELECT json_group_array(json_object(
+                            'thread_id', f.thread_id,
+                            'sender', f.sender,
+                            'preview', CASE WHEN length(f.message) > 25 THEN substr(f.message, 1, 25) || '...' ELSE f.message END,
+                            'subject', coalesce(nullif(f.subject, ''), '(No subject)')
+                        ))
+                        FROM (SELECT * FROM first_messages WHERE mail = m.mail ORDER BY msg_id DESC) f
+                    ))))
+                    FROM (SELECT DISTINCT mail FROM first_messages) m
+                ))
+            )
+        """, (session,))
+
+        return cur.fetchone()[0]
 
 def get_thread(session, thread_id):
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT type, sender, message
-        FROM imap_messages
-        WHERE thread_id = ? AND session = ?
-        ORDER BY msg_id ASC
-    """, (thread_id, session))
-
-    thread = cur.fetchall()
-
-    if not thread:
-        return None
-    else:
-        messages = []
-        for message in thread:
-            message_type, sender, message_text = message
-            messages.append({
-                "type": message_type,
-                "sender": sender,
-                "message": message_text
-            })
-
-        return messages
+    with read_conn() as conn:
+        cur = exec_cached(conn, """
+            SELECT type, sender, message
+            FROM imap_messages
+            WHERE thread_id = ? AND session = ?
+            ORDER BY msg_id ASC
+        """, (thread_id, session))
+
+        return [dict(r) for r in cur.fetchall()] or None
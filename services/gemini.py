@@ -1,9 +1,12 @@
-import json
+import asyncio
+import threading
+
+import orjson
 
 from google import genai
 from google.genai.types import GenerateContentConfig
 
-from ReplyOptimizer.db_functions.users_functions import get_session
+from db_functions.users_functions import get_session
 
 
 STABLE_INSTRUCTION = """
@@ -15,43 +18,62 @@ Do not use emojis or fabricate information.
 If the message is promotional, irrelevant, or unrelated to instructions, return {"body": false}.
 """
 
+_STABLE_BLOCK = STABLE_INSTRUCTION.replace("{", "{{").replace("}", "}}")
+
+_PROMPT_NO_CONV = _STABLE_BLOCK + """
+Consider the following instructions:
+{instr}
+
+Customer email:
+{email}
+"""
+
+_PROMPT_CONV = _STABLE_BLOCK + """
+Consider the following instructions:
+{instr}
+
+Conversation(in format sender, message, type): {conv}
+
+Customer email:
+{email}
+"""
+
 def build_prompt(email_text: str, conversation, dynamic_role_instruction: str) -> str:
     if not conversation:
-        return f"""
-            {STABLE_INSTRUCTION}
-            
-            Consider the following instructions:
-            {dynamic_role_instruction}
-            
-            Customer email:
-            {email_text}
-        """
+        return _PROMPT_NO_CONV.format_map({"instr": dynamic_role_instruction, "email": email_text})
     else:
-        return f"""
-            {STABLE_INSTRUCTION}
+        return _PROMPT_CONV.format_map({"instr": dynamic_role_instruction, "conv": conversation, "email": email_text})
+
+
+class GeminiClientCache:
+    def __init__(self):
+        self._clients: dict[str, genai.Client] = {}
+        self._lock = threading.Lock()
 
-            Consider the following instructions:
-            {dynamic_role_instruction}
-            
-            Conversation(in format sender, message, type): {conversation}
+    def get(self, api_key: str) -> genai.Client:
+        client = self._clients.get(api_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(api_key)
+                if client is None:
+                    client = self._clients[api_key] = genai.Client(api_key=api_key)
+        return client
 
-            Customer email:
-            {email_text}
-        """
+_clients = GeminiClientCache()
 
 
-def gemini_answer(text, conversation, session):
-    user = get_session(session)
+async def gemini_answer(text, conversation, session):
+    user = await asyncio.to_thread(get_session, session)
     if not user:
         return None, "user_not_found"
 
     prompt = build_prompt(text, conversation, user.get("instructions"))
     prompt_len = len(prompt)
 
-    client = genai.Client(api_key=user.get("gemini_key"))
+    client = _clients.get(user.get("gemini_key"))
 
     try:
-        response = client.models.generate_content(
+        response = await client.aio.models.generate_content(
             model="gemini-2.0-pro",
             contents=prompt,
             config=GenerateContentConfig(
@@ -65,8 +87,8 @@ def gemini_answer(text, conversation, session):
     raw_text = response.text or ""
 
     try:
-        data = json.loads(raw_text)
-    except json.JSONDecodeError:
+        data = orjson.loads(raw_text)
+    except orjson.JSONDecodeError:
         return None, "invalid_json"
 
     body = data.get("body")
@@ -1,29 +1,59 @@
 import asyncio
-import json
+import atexit
+import itertools
 import os
-import sqlite3
 import logging
+import queue
+import re
 import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import OrderedDict
 from typing import Dict
 
 import aiohttp
 import aioimaplib
 import aiosmtplib
-from email.message import EmailMessage
-from email import message_from_bytes
+import orjson
+from email.message import EmailMessage, Message
+from email.parser import BytesHeaderParser, BytesParser
+from email.policy import default as default_policy
 from email.utils import parseaddr
 
 from ddtrace import tracer
 
-from ReplyOptimizer.db_functions.users_functions import get_session, insert_message_async
-from ReplyOptimizer.worker.services.gemini import gemini_answer
-
-USERS_DB = "users.db"
+from db_functions.pool import data_version, exec_cached, read_conn
+from db_functions.users_functions import get_session, insert_message_async
+from services.gemini import gemini_answer
 
 os.makedirs("logs", exist_ok=True)
 
 _session_loggers: Dict[str, logging.Logger] = {}
 
+class SessionFileHandler(logging.Handler):
+    # runs on the listener thread and routes each record to its session's file
+    def __init__(self):
+        super().__init__()
+        self.handlers: Dict[str, logging.Handler] = {}
+
+    def add(self, logger_name: str, filename: str):
+        file_handler = RotatingFileHandler(filename, maxBytes=50_000_000, backupCount=5)
+        file_handler.setFormatter(logging.Formatter(
+            "%(asctime)s [%(levelname)s] %(name)s | mailbox:%(mailbox)s | thread:%(thread_id)s: %(message)s",
+            defaults={"mailbox": "-", "thread_id": "-"}
+        ))
+        self.handlers[logger_name] = file_handler
+
+    def emit(self, record: logging.LogRecord):
+        handler = self.handlers.get(record.name)
+        if handler:
+            handler.handle(record)
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_session_file_handler = SessionFileHandler()
+_log_listener = QueueListener(_log_queue, _session_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 def get_session_logger(session: str) -> logging.Logger:
     if session in _session_loggers:
         return _session_loggers[session]
@@ -35,47 +65,105 @@ def get_session_logger(session: str) -> logging.Logger:
         _session_loggers[session] = session_logger
         return session_logger
 
-    file_handler = logging.FileHandler(f"logs/session_{session[:8]}.log")
-    file_handler.setFormatter(logging.Formatter(
-        "%(asctime)s [%(levelname)s] %(name)s | mailbox:%(mailbox)s | thread:%(thread_id)s: %(message)s",
-        defaults={"mailbox": "-", "thread_id": "-"}
-    ))
+    # file writes happen on the listener thread, never on the event loop
+    _session_file_handler.add(logger_name, f"logs/session_{session[:8]}.log")
 
     session_logger.setLevel(logging.INFO)
-    session_logger.addHandler(file_handler)
+    session_logger.addHandler(QueueHandler(_log_queue))
     session_logger.propagate = False
 
     _session_loggers[session] = session_logger
     return session_logger
 
+_DD_CLIENTS: Dict[tuple[str, str], "DatadogMetrics"] = {}
+
 class DatadogMetrics:
+    MAX_BATCH = 100
+    FLUSH_INTERVAL = 2.0
+    RESEND_INTERVAL = 5 * 60
+
     def __init__(self, api_key: str, site: str = "datadoghq.com"):
         self.api_key = api_key.strip()
         self.site = site.strip().lower()
         self.base_url = f"https://api.{self.site}"
         self.headers = {
-            "Content-Type": "application/json",
             "DD-API-KEY": self.api_key
         }
         self.session: aiohttp.ClientSession | None = None
+        self.logger = logging.getLogger("reply_optimizer.datadog")
+
+        self._series_buf: list[dict] = []
+        self._checks_buf: list[dict] = []
+        self._flush_event: asyncio.Event | None = None
+        self._flush_task: asyncio.Task | None = None
+        self._last: dict[tuple, tuple[float, float]] = {}
+
+    @classmethod
+    def get(cls, api_key: str, site: str = "datadoghq.com") -> "DatadogMetrics":
+        # one client (and connection pool) per Datadog account, shared by every session
+        key = (api_key.strip(), site.strip().lower())
+        client = _DD_CLIENTS.get(key)
+        if client is None:
+            client = _DD_CLIENTS[key] = cls(api_key, site)
+        return client
+
+    @staticmethod
+    async def close_all():
+        clients = list(_DD_CLIENTS.values())
+        _DD_CLIENTS.clear()
+        await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
 
     async def _get_session(self) -> aiohttp.ClientSession:
         if self.session is None or self.session.closed:
-            self.session = aiohttp.ClientSession(headers=self.headers)
+            connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=75)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers)
         return self.session
 
-    async def _post(self, endpoint: str, payload: dict):
+    async def _post(self, endpoint: str, payload: dict | list):
         url = f"{self.base_url}{endpoint}"
         try:
-            async with await self._get_session() as session:
-                async with session.post(url, data=json.dumps(payload), timeout=10) as resp:
-                    if resp.status in (200, 202, 204):
-                        return
-                    text = await resp.text()
-                    self.logger.warning(f"Datadog API error {resp.status}: {text[:200]}")
+            session = await self._get_session()
+            body = orjson.dumps(payload)
+            async with session.post(
+                url,
+                data=body,
+                headers={"Content-Type": "application/json"},
+                timeout=aiohttp.ClientTimeout(total=10)
+            ) as resp:
+                if resp.status in (200, 202, 204):
+                    return
+                text = await resp.text()
+                self.logger.warning(f"Datadog API error {resp.status}: {text[:200]}")
         except Exception as e:
             self.logger.warning(f"Datadog send exception: {e}")
 
+    def _schedule_flush(self, force: bool = False):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_event = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flusher())
+
+        if force:
+            self._flush_event.set()
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+            self._flush_event.clear()
+            await self.flush()
+
+    async def flush(self):
+        series, self._series_buf = self._series_buf, []
+        checks, self._checks_buf = self._checks_buf, []
+
+        if series:
+            await self._post("/api/v1/series", {"series": series})
+        if checks:
+            await self._post("/api/v1/check_run", checks)
+
     async def submit_metric(
         self,
         metric_name: str,
@@ -87,17 +175,28 @@ class DatadogMetrics:
         if timestamp is None:
             timestamp = int(time.time())
 
-        series = {
-            "series": [{
-                "metric": metric_name,
-                "points": [[timestamp, value]],
-                "type": metric_type,
-                "tags": tags or []
-            }]
-        }
-        await self._post("/api/v1/series", series)
+        self._series_buf.append({
+            "metric": metric_name,
+            "points": [[timestamp, value]],
+            "type": metric_type,
+            "tags": tags or []
+        })
+        self._schedule_flush(force=len(self._series_buf) >= self.MAX_BATCH)
+
+    def _unchanged(self, key: tuple, value: float) -> bool:
+        now = time.monotonic()
+        last = self._last.get(key)
+        # repeat an unchanged value now and then so Datadog never sees it as stale
+        if last and last[0] == value and now - last[1] < self.RESEND_INTERVAL:
+            return True
+
+        self._last[key] = (value, now)
+        return False
 
     async def gauge(self, metric_name: str, value: float, tags: list[str] | None = None):
+        if self._unchanged(("gauge", metric_name, *sorted(tags or [])), value):
+            return
+
         await self.submit_metric(metric_name, value, "gauge", tags)
 
     async def count(self, metric_name: str, value: int = 1, tags: list[str] | None = None):
@@ -116,60 +215,239 @@ class DatadogMetrics:
         tags: list[str] | None = None,
         message: str = ""
     ):
-        payload = {
+        if self._unchanged(("check", check_name, *sorted(tags or [])), status):
+            return
+
+        self._checks_buf.append({
             "check": check_name,
             "status": status,
             "tags": tags or [],
             "message": message,
             "timestamp": int(time.time())
-        }
-        await self._post("/api/v1/check_run", payload)
+        })
+        self._schedule_flush(force=len(self._checks_buf) >= self.MAX_BATCH)
 
     async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+
+        await self.flush()
+
         if self.session and not self.session.closed:
             await self.session.close()
 
-def _sqlite_fetchone(query, params=()):
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-    cur.execute(query, params)
-    row = cur.fetchone()
-    conn.close()
-    return row
-
+THREAD_ROWS_SQL = "SELECT sender, message, type FROM imap_messages WHERE thread_id = ? ORDER BY msg_id ASC"
+SESSIONS_SQL = "SELECT session FROM users"
 
 def _sqlite_fetchall(query, params=()):
-    conn = sqlite3.connect(USERS_DB)
-    cur = conn.cursor()
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def get_text_body(msg):
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                return part.get_payload(decode=True).decode(errors="ignore")
-    return msg.get_payload(decode=True).decode(errors="ignore")
+    with read_conn() as conn:
+        rows = exec_cached(conn, query, params).fetchall()
+    return [tuple(r) for r in rows]
+
+_THREAD_CACHE_SIZE = 4096
+_THREAD_CACHE: OrderedDict[str, bool] = OrderedDict()
+
+def _thread_known(thread_id: str) -> bool | None:
+    known = _THREAD_CACHE.get(thread_id)
+    if known is not None:
+        _THREAD_CACHE.move_to_end(thread_id)
+    return known
+
+def _remember_thread(thread_id: str, known: bool):
+    _THREAD_CACHE[thread_id] = known
+    _THREAD_CACHE.move_to_end(thread_id)
+    if len(_THREAD_CACHE) > _THREAD_CACHE_SIZE:
+        _THREAD_CACHE.popitem(last=False)
+
+def _part_text(part: EmailMessage) -> str:
+    try:
+        return part.get_content()
+    except LookupError:
+        # unknown charset; decode as UTF-8 rather than drop a message that is already flagged \Seen
+        return (part.get_payload(decode=True) or b"").decode("utf-8", "replace")
+
+def get_text_body(msg: EmailMessage) -> str:
+    part = msg.get_body(preferencelist=("plain", "html"))
+    return _part_text(part) if part else ""
+
+_IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{\d+\}$|([^\s()"]+))')
+
+def _parse_fetch(lines, uid: str) -> dict[bytes, object]:
+    # aioimaplib hands literals over as separate bytearray items
+    stack: list[list] = [[]]
+    for line in lines:
+        if isinstance(line, bytearray):
+            stack[-1].append(bytes(line))
+            continue
+
+        pos = 0
+        while (m := _IMAP_TOKEN_RE.match(line, pos)) and m.end() > pos:
+            pos = m.end()
+            opening, closing, quoted, atom = m.groups()
+            if opening:
+                stack.append([])
+            elif closing and len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb"\\(.)", rb"\1", quoted))
+            elif atom is not None:
+                stack[-1].append(None if atom.upper() == b"NIL" else atom)
+
+    # servers may send unsolicited FETCH responses (e.g. FLAGS) for this or other messages
+    items = {}
+    tokens = stack[0]
+    for i in range(2, len(tokens)):
+        name = tokens[i - 1]
+        if isinstance(tokens[i], list) and isinstance(name, bytes) and name.upper() == b"FETCH" and tokens[i - 2] == uid.encode():
+            items.update((k.upper(), v) for k, v in zip(tokens[i][::2], tokens[i][1::2]))
+    return items
+
+def _find_plain_part(structure: list, path: tuple[int, ...] = ()) -> tuple[str, bytes, bytes] | None:
+    if isinstance(structure[0], list):
+        parts = itertools.takewhile(lambda p: isinstance(p, list), structure)
+        for i, part in enumerate(parts, 1):
+            found = _find_plain_part(part, path + (i,))
+            if found:
+                return found
+        return None
+
+    if structure[0].lower() == b"text" and structure[1].lower() == b"plain":
+        params = structure[2] or []
+        charset = next((v for k, v in zip(params[::2], params[1::2]) if k.lower() == b"charset"), None)
+        section = ".".join(map(str, path or (1,)))
+        return section, charset or b"us-ascii", structure[5] or b"7bit"
+
+    return None
+
+async def fetch_message(client, uid) -> tuple[Message, str]:
+    uid = uid.decode() if isinstance(uid, bytes) else uid
+
+    # pull only the headers and the first text/plain part; attachments stay on the server
+    response = await client.fetch(uid, "(BODYSTRUCTURE BODY.PEEK[HEADER])")
+    try:
+        items = _parse_fetch(response.lines, uid)
+        headers = BytesHeaderParser(policy=default_policy).parsebytes(items[b"BODY[HEADER]"])
+        plain = _find_plain_part(items[b"BODYSTRUCTURE"])
+    except Exception:
+        plain = None
+
+    if plain:
+        section, charset, encoding = plain
+        # not PEEK: like the old RFC822 fetch this sets \Seen, so a failing message is not answered again
+        response = await client.fetch(uid, f"(BODY[{section}])")
+        payload = _parse_fetch(response.lines, uid).get(f"BODY[{section}]".encode())
+        if payload is not None:
+            part = BytesParser(policy=default_policy).parsebytes(
+                b"Content-Type: text/plain; charset=\"%s\"\r\nContent-Transfer-Encoding: %s\r\n\r\n%s" % (charset, encoding, payload)
+            )
+            return headers, _part_text(part)
+
+    response = await client.fetch(uid, "(RFC822)")
+    msg = BytesParser(policy=default_policy).parsebytes(_parse_fetch(response.lines, uid)[b"RFC822"])
+    return msg, get_text_body(msg)
+
+# IMAP command failures that leave the connection unusable; anything else keeps the logged-in client
+_IMAP_CONNECTION_ERRORS = (aioimaplib.Abort, aioimaplib.CommandTimeout, asyncio.TimeoutError, OSError)
+
+IMAP_KEEPALIVE_INTERVAL = 5 * 60
+
+async def _logout(client: aioimaplib.IMAP4_SSL):
+    try:
+        await asyncio.wait_for(client.logout(), 5)
+    except Exception:
+        pass
+
+    # LOGOUT may never have reached the server; make sure the socket is released
+    transport = getattr(client.protocol, "transport", None)
+    if transport is not None and not transport.is_closing():
+        transport.close()
+
+class MailboxClient:
+    def __init__(self, mail: str, password: str, imap_host: str, imap_port: int, smtp_host: str, smtp_port: int):
+        self.mail = mail
+        self.password = password
+        self.imap_host = imap_host
+        self.imap_port = imap_port
+        self.imap: aioimaplib.IMAP4_SSL | None = None
+        self.smtp = aiosmtplib.SMTP(
+            hostname=smtp_host,
+            port=smtp_port,
+            username=mail,
+            password=password,
+            start_tls=True,
+            timeout=10
+        )
+        # aiosmtplib connections are not safe for concurrent use
+        self.smtp_lock = asyncio.Lock()
+
+    async def connect_imap(self) -> aioimaplib.IMAP4_SSL:
+        if self.imap is not None:
+            return self.imap
+
+        client = aioimaplib.IMAP4_SSL(self.imap_host, self.imap_port)
+        try:
+            await client.wait_hello_from_server()
+
+            response = await client.login(self.mail, self.password)
+            if response.result != "OK":
+                raise ConnectionError(f"IMAP login failed: {response.result}")
+
+            await client.select("INBOX")
+        except BaseException:
+            await _logout(client)
+            raise
+
+        self.imap = client
+        return client
+
+    async def logout_imap(self):
+        client, self.imap = self.imap, None
+        if client:
+            await _logout(client)
+
+    async def send(self, msg: EmailMessage):
+        async with self.smtp_lock:
+            if not self.smtp.is_connected:
+                await self.smtp.connect()
+
+            try:
+                await self.smtp.send_message(msg)
+            except Exception:
+                # drop the connection so the next attempt starts a fresh session
+                self.smtp.close()
+                raise
+
+    async def close(self):
+        await self.logout_imap()
+
+        async with self.smtp_lock:
+            if self.smtp.is_connected:
+                try:
+                    await self.smtp.quit()
+                except Exception:
+                    self.smtp.close()
 
 class SessionWorker:
     def __init__(self, session: str):
         self.session = session
-        self.tasks: Dict[str, tuple[asyncio.Task, asyncio.Event]] = {}
+        self.tasks: Dict[str, tuple[asyncio.Task, asyncio.Event, MailboxClient]] = {}
         self.dd: DatadogMetrics | None = None
         self.running = True
         self.lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(8)
         self.logger = get_session_logger(session)
 
     async def sync_accounts(self):
         async with self.lock:
-            data = await asyncio.to_thread(get_session, self.session)
+            data = get_session(self.session)
             if not data:
                 return
 
             if not self.dd:
-                self.dd = DatadogMetrics(data.get("datadog_api_key"), data.get("datadog_site"))
+                self.dd = DatadogMetrics.get(data.get("datadog_api_key"), data.get("datadog_site"))
                 self.logger.info("Datadog initialized", extra={"session": self.session})
 
             db_accounts = {a["mail"]: a for a in data["imap_accounts"]}
@@ -180,49 +458,70 @@ class SessionWorker:
                 stop_event = asyncio.Event()
                 acc = db_accounts[mail]
 
+                try:
+                    imap_port, smtp_port = int(acc["imap_port"]), int(acc["smtp_port"])
+                except (TypeError, ValueError):
+                    self.logger.error("Invalid port for mailbox", extra={"mailbox": mail, "session": self.session})
+                    continue
+
+                mailbox = MailboxClient(
+                    mail=mail,
+                    password=acc["password"],
+                    imap_host=acc["imap_host"],
+                    imap_port=imap_port,
+                    smtp_host=acc["smtp_host"],
+                    smtp_port=smtp_port
+                )
+
                 task = asyncio.create_task(
                     imap_worker(
                         session=self.session,
-                        mail=mail,
-                        password=acc["password"],
-                        imap_host=acc["imap_host"],
-                        smtp_host=acc["smtp_host"],
+                        mailbox=mailbox,
                         stop_event=stop_event,
+                        semaphore=self.semaphore,
                         dd=self.dd,
                         logger=self.logger
                     )
                 )
 
-                self.tasks[mail] = (task, stop_event)
+                self.tasks[mail] = (task, stop_event, mailbox)
 
                 await self.dd.increment(
                     "imap.accounts.started",
-                    tags=[f"mailbox:{mail}"]
+                    tags=[f"session:{self.session}", f"mailbox:{mail}"]
                 )
 
             # stop removed
             for mail in current - desired:
-                task, stop_event = self.tasks.pop(mail)
+                task, stop_event, mailbox = self.tasks.pop(mail)
                 stop_event.set()
                 task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await mailbox.close()
 
                 await self.dd.increment(
                     "imap.accounts.stopped",
-                    tags=[f"mailbox:{mail}"]
+                    tags=[f"session:{self.session}", f"mailbox:{mail}"]
                 )
 
             await self.dd.gauge(
                 "imap.accounts.active",
-                len(self.tasks)
+                len(self.tasks),
+                tags=[f"session:{self.session}"]
             )
 
     async def stop(self):
         self.running = False
-        for task, stop_event in self.tasks.values():
+        for task, stop_event, _ in self.tasks.values():
             stop_event.set()
             task.cancel()
 
-        await asyncio.gather(*(t for t, _ in self.tasks.values()), return_exceptions=True)
+        await asyncio.gather(*(t for t, _, _ in self.tasks.values()), return_exceptions=True)
+        await asyncio.gather(*(m.close() for _, _, m in self.tasks.values()), return_exceptions=True)
+
+        # the client is shared with other sessions, so only push what is buffered
+        if self.dd:
+            await self.dd.flush()
 
     async def run(self):
         while self.running:
@@ -231,147 +530,187 @@ class SessionWorker:
 
 async def imap_worker(
     session: str,
-    mail: str,
-    password: str,
-    imap_host: str,
-    smtp_host: str,
+    mailbox: MailboxClient,
     stop_event: asyncio.Event,
+    semaphore: asyncio.Semaphore,
     dd: DatadogMetrics,
     logger: logging.Logger
 ):
-    host, port = imap_host.split(":")
-    smtp_host, smtp_port = smtp_host.split(":")
+    mail = mailbox.mail
 
     while not stop_event.is_set():
-        client = None
         try:
-            client = aioimaplib.IMAP4_SSL(host, int(port))
-            await client.wait_hello_from_server()
-            await client.login(mail, password)
-            await client.select("INBOX")
-
-            await dd.service_check(
-                "imap.health",
-                0,
-                tags=[f"mailbox:{mail}"]
-            )
+            reconnected = mailbox.imap is None
+            client = await mailbox.connect_imap()
 
-            logger.info("IMAP connected", extra={"mailbox": mail, "session": session})
-
-            while not stop_event.is_set():
-                await asyncio.sleep(30)
+            if reconnected:
+                await dd.service_check(
+                    "imap.health",
+                    0,
+                    tags=[f"session:{session}", f"mailbox:{mail}"]
+                )
 
+                logger.info("IMAP connected", extra={"mailbox": mail, "session": session})
+
+            # aioimaplib multiplexes every command over one connection
+            imap_lock = asyncio.Lock()
+
+            async def process(uid):
+                async with semaphore:
+                    # IMAP failures propagate to the connection handling below
+                    with tracer.trace("imap.fetch", service="reply-optimizer"):
+                        async with imap_lock:
+                            msg, text = await fetch_message(client, uid)
+
+                    try:
+                        await handle_message(
+                            msg=msg,
+                            text=text,
+                            session=session,
+                            mail=mail,
+                            mailbox=mailbox,
+                            dd=dd,
+                            logger=logger
+                        )
+                    except Exception:
+                        logger.exception("Failed to handle message", extra={"mailbox": mail, "session": session})
+                        await dd.increment(
+                            "errors.total",
+                            tags=[f"session:{session}", "component:message", f"mailbox:{mail}"]
+                        )
+                        return uid, False
+
+                return uid, True
+
+            async def drain(skip: set) -> set:
                 with tracer.trace("imap.search", service="reply-optimizer"):
-                    _, data = await client.search("UNSEEN")
-
-                if not data or not data[0]:
-                    continue
+                    async with imap_lock:
+                        _, data = await client.search("UNSEEN")
 
-                for uid in data[0].split():
-                    await handle_message(
-                        client=client,
-                        uid=uid,
-                        session=session,
-                        mail=mail,
-                        smtp_host=smtp_host,
-                        smtp_port=int(smtp_port),
-                        password=password,
-                        dd=dd,
-                        logger=logger
-                    )
+                uids = [uid for uid in (data[0].split() if data and data[0] else []) if uid not in skip]
+                if not uids:
+                    return set()
 
-                    await client.store(uid, "+FLAGS", "\\Seen")
+                results = await asyncio.gather(
+                    *(process(uid) for uid in uids),
+                    return_exceptions=True
+                )
 
-                    await dd.increment(
+                # failed messages are flagged too, so they are not answered again on the next pass
+                fetched = [r for r in results if not isinstance(r, BaseException)]
+                if fetched:
+                    try:
+                        uid_set = ",".join(u.decode() if isinstance(u, bytes) else u for u, _ in fetched)
+                        async with imap_lock:
+                            await client.store(uid_set, "+FLAGS", "\\Seen")
+                    except Exception:
+                        logger.warning("Failed to flag messages as seen", extra={"mailbox": mail, "session": session})
+
+                    await dd.count(
                         "emails.processed",
-                        tags=[f"mailbox:{mail}"]
+                        sum(ok for _, ok in fetched),
+                        tags=[f"session:{session}", f"mailbox:{mail}"]
                     )
 
+                errors = [r for r in results if isinstance(r, BaseException)]
+                if errors:
+                    raise errors[0]
+
+                return {uid for uid, _ in fetched}
+
+            def has_new_mail(lines) -> bool:
+                return any(b"EXISTS" in line or b"RECENT" in line for line in lines if isinstance(line, bytes))
+
+            async def wait_for_mail() -> bool:
+                async with imap_lock:
+                    # re-issue IDLE every few minutes so NAT/firewall state stays alive
+                    idle = await client.idle_start(timeout=IMAP_KEEPALIVE_INTERVAL)
+                    try:
+                        while client.has_pending_idle():
+                            push = await client.wait_server_push()
+                            if push == aioimaplib.STOP_WAIT_SERVER_PUSH:
+                                break
+                            if has_new_mail(push):
+                                return True
+                    finally:
+                        if client.has_pending_idle():
+                            client.idle_done()
+                            await asyncio.wait_for(idle, 5)
+
+                # drain on every keepalive as well: its SEARCH keeps the connection alive and picks up
+                # mail whose EXISTS was never seen by IDLE
+                return True
+
+            use_idle = client.has_capability("IDLE")
+            new_mail = True
+
+            while not stop_event.is_set():
+                if new_mail:
+                    # mail arriving mid-drain is announced in that drain's own responses, so search again until nothing is new
+                    handled = set()
+                    while batch := await drain(handled):
+                        handled |= batch
+
+                if use_idle:
+                    new_mail = await wait_for_mail()
+                else:
+                    await asyncio.sleep(30)
+
         except asyncio.CancelledError:
             break
 
-        except Exception:
+        except Exception as e:
             logger.exception("IMAP error", extra={"mailbox": mail, "session": session})
 
             await dd.increment(
                 "errors.total",
-                tags=["component:imap", f"mailbox:{mail}"]
+                tags=[f"session:{session}", "component:imap", f"mailbox:{mail}"]
             )
 
-            await dd.service_check(
-                "imap.health",
-                2,
-                tags=[f"mailbox:{mail}"]
-            )
+            if isinstance(e, _IMAP_CONNECTION_ERRORS):
+                await mailbox.logout_imap()
 
-            await asyncio.sleep(5)
+                await dd.service_check(
+                    "imap.health",
+                    2,
+                    tags=[f"session:{session}", f"mailbox:{mail}"]
+                )
 
-        finally:
-            if client:
-                try:
-                    await client.logout()
-                except Exception:
-                    pass
+            await asyncio.sleep(5)
 
 async def handle_message(
-    client,
-    uid,
+    msg: Message,
+    text: str,
     session,
     mail,
-    smtp_host,
-    smtp_port,
-    password,
+    mailbox: MailboxClient,
     dd: DatadogMetrics,
     logger: logging.Logger
 ):
-    with tracer.trace("imap.fetch", service="reply-optimizer"):
-        _, msg_data = await client.fetch(uid, "(RFC822)")
-
-    msg = message_from_bytes(msg_data[0][1])
-    text = get_text_body(msg)
-
     _, to_email = parseaddr(msg.get("From", ""))
     subject = msg.get("Subject", "")
 
     msg_id = msg.get("Message-ID")
     in_reply_to = msg.get("In-Reply-To")
 
-    if in_reply_to:
-        row = await asyncio.to_thread(
-            _sqlite_fetchone,
-            "SELECT session FROM imap_messages WHERE thread_id = ?",
-            (in_reply_to,)
-        )
-        thread_id = in_reply_to if row else msg_id
-        is_new = not bool(row)
-    else:
-        thread_id = msg_id
-        is_new = True
-
     conversation = []
-    if not is_new:
-        conversation = await asyncio.to_thread(
-            _sqlite_fetchall,
-            """
-            SELECT sender, message, type
-            FROM imap_messages
-            WHERE thread_id = ?
-            ORDER BY msg_id ASC
-            """,
-            (thread_id,)
-        )
+    known = _thread_known(in_reply_to) if in_reply_to else False
+    if known is not False:
+        # WAL readers never wait on the writer, so this small indexed read runs on the loop
+        conversation = _sqlite_fetchall(THREAD_ROWS_SQL, (in_reply_to,))
+        # a known thread can still read back empty while its rows sit in the write queue
+        if known is None:
+            _remember_thread(in_reply_to, bool(conversation))
+
+    thread_id = in_reply_to if conversation or known else msg_id
 
     with tracer.trace("gemini.answer", service="reply-optimizer"):
-        body, status = await asyncio.to_thread(
-            gemini_answer, text, conversation, session
-        )
+        body, status = await gemini_answer(text, conversation, session)
 
     await send_reply(
         session=session,
-        smtp_host=smtp_host,
-        smtp_port=smtp_port,
+        mailbox=mailbox,
         mail=mail,
-        password=password,
         to=to_email,
         subject=f"Re: {subject}",
         first_subject = subject,
@@ -383,12 +722,19 @@ async def handle_message(
         logger=logger
     )
 
+def build_reply(mail: str, to: str, subject: str, body: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = mail
+    msg["To"] = to
+    msg["Subject"] = subject
+    # a fixed CTE skips the scan over the whole body that picks one
+    msg.set_content(body, cte="quoted-printable")
+    return msg
+
 async def send_reply(
     session,
-    smtp_host,
-    smtp_port,
+    mailbox: MailboxClient,
     mail,
-    password,
     to,
     subject,
     first_subject,
@@ -404,16 +750,17 @@ async def send_reply(
     await insert_message_async(
         session, thread_id, "incoming", to, original_text, first_subject, mail
     )
+    _remember_thread(thread_id, True)
 
     await dd.increment(
         "gemini.outcome",
-        tags=[f"status:{status}", f"mailbox:{mail}", thread_tag]
+        tags=[f"session:{session}", f"status:{status}", f"mailbox:{mail}", thread_tag]
     )
 
     if not body:
         await dd.increment(
             "errors.by_type",
-            tags=[f"type:{status}", f"mailbox:{mail}"]
+            tags=[f"session:{session}", f"type:{status}", f"mailbox:{mail}"]
         )
         logger.warning(
             "LLM returned no body",
@@ -428,8 +775,16 @@ async def send_reply(
 
     if isinstance(body, dict) and "meta" in body:
         meta = body["meta"]
-        await dd.histogram("gemini.prompt.chars", meta.get("prompt_chars", 0))
-        await dd.histogram("gemini.response.chars", meta.get("response_chars", 0))
+        await dd.histogram(
+            "gemini.prompt.chars",
+            meta.get("prompt_chars", 0),
+            tags=[f"session:{session}", f"mailbox:{mail}"]
+        )
+        await dd.histogram(
+            "gemini.response.chars",
+            meta.get("response_chars", 0),
+            tags=[f"session:{session}", f"mailbox:{mail}"]
+        )
 
         body = body["body"]
 
@@ -437,11 +792,7 @@ async def send_reply(
         session, thread_id, "outcoming", mail, body, subject, mail
     )
 
-    msg = EmailMessage()
-    msg["From"] = mail
-    msg["To"] = to
-    msg["Subject"] = subject
-    msg.set_content(body)
+    msg = await asyncio.to_thread(build_reply, mail, to, subject, body)
 
     for attempt in (1, 2):
         try:
@@ -450,25 +801,17 @@ async def send_reply(
                 service="reply-optimizer",
                 resource=mail
             ):
-                await aiosmtplib.send(
-                    msg,
-                    hostname=smtp_host,
-                    port=smtp_port,
-                    start_tls=True,
-                    username=mail,
-                    password=password,
-                    timeout=10
-                )
+                await mailbox.send(msg)
 
             await dd.increment(
                 "smtp.sent",
-                tags=[f"mailbox:{mail}", thread_tag]
+                tags=[f"session:{session}", f"mailbox:{mail}", thread_tag]
             )
 
             await dd.service_check(
                 "smtp.health",
                 0,
-                tags=[f"mailbox:{mail}"]
+                tags=[f"session:{session}", f"mailbox:{mail}"]
             )
 
             logger.info(
@@ -485,14 +828,14 @@ async def send_reply(
         except Exception:
             await dd.increment(
                 "errors.total",
-                tags=["component:smtp", f"mailbox:{mail}"]
+                tags=[f"session:{session}", "component:smtp", f"mailbox:{mail}"]
             )
 
             if attempt == 2:
                 await dd.service_check(
                     "smtp.health",
                     2,
-                    tags=[f"mailbox:{mail}"]
+                    tags=[f"session:{session}", f"mailbox:{mail}"]
                 )
                 logger.exception(
                     "SMTP send failed",
@@ -509,30 +852,53 @@ async def send_reply(
 class SessionManager:
     def __init__(self):
         self.sessions: Dict[str, SessionWorker] = {}
+        self.lock = asyncio.Lock()
+        self.data_version: int | None = None
 
-    def _load_sessions(self):
-        conn = sqlite3.connect(USERS_DB)
-        cur = conn.cursor()
-        cur.execute("SELECT session FROM users")
-        rows = cur.fetchall()
-        conn.close()
+    def _load_sessions(self) -> set[str] | None:
+        version = data_version()
+        if version == self.data_version:
+            return None
+
+        with read_conn() as conn:
+            rows = exec_cached(conn, SESSIONS_SQL).fetchall()
+
+        self.data_version = version
         return {r[0] for r in rows}
 
-    async def sync_sessions(self):
-        sessions = await asyncio.to_thread(self._load_sessions)
+    async def sync_sessions(self) -> bool:
+        sessions = self._load_sessions()
+        if sessions is None:
+            return False
+
+        async with self.lock:
+            for s in sessions - self.sessions.keys():
+                worker = SessionWorker(s)
+                self.sessions[s] = worker
+                asyncio.create_task(worker.run())
+
+            for s in list(self.sessions.keys() - sessions):
+                worker = self.sessions.pop(s)
+                await worker.stop()
+
+        return True
+
+    async def stop(self):
+        async with self.lock:
+            workers = list(self.sessions.values())
+            self.sessions.clear()
 
-        for s in sessions - self.sessions.keys():
-            worker = SessionWorker(s)
-            self.sessions[s] = worker
-            asyncio.create_task(worker.run())
+        await asyncio.gather(*(w.stop() for w in workers), return_exceptions=True)
+        await DatadogMetrics.close_all()
 
-        for s in list(self.sessions.keys() - sessions):
-            worker = self.sessions.pop(s)
-            await worker.stop()
+SYNC_INTERVAL = 30
+MAX_SYNC_INTERVAL = 5 * 60
 
 async def main():
     manager = SessionManager()
+    interval = SYNC_INTERVAL
 
     while True:
-        await manager.sync_sessions()
-        await asyncio.sleep(30)
\ No newline at end of file
+        changed = await manager.sync_sessions()
+        interval = SYNC_INTERVAL if changed else min(interval * 2, MAX_SYNC_INTERVAL)
+        await asyncio.sleep(interval)
\ No newline at end of file